@@ -11,6 +11,7 @@ from xaux.fs import *
 from xaux.fs.afs import _afs_mounted
 from xaux.fs.eos_methods import _xrdcp_installed, _eoscmd_installed, _eos_mounted
 import xaux.fs  # to set test flags
+import xaux.fs.io
 
 from test_fs import _afs_test_path, _eos_test_path
 
@@ -65,6 +66,68 @@ def test_fspath_methods(test_user):
         path_eos_link.unlink()
 
 
+def test_file_io_local():
+    local_file = FsPath("test_cp_local_source.txt")
+    local_copy = FsPath("test_cp_local_target.txt")
+    for f in [local_file, local_copy]:
+        if f.exists():
+            f.unlink()
+    local_file.write_text("Some text\n" * 5000)
+    local_file.chmod(0o640)
+    local_file.copy_to(local_copy)
+    assert local_copy.read_text() == local_file.read_text()
+    assert local_copy.stat().st_mode == local_file.stat().st_mode
+    assert local_copy.stat().st_mtime_ns == local_file.stat().st_mtime_ns
+    # Overwriting a larger file should truncate it
+    local_copy.write_text("Some other text\n" * 10000)
+    cp(local_file, local_copy)
+    assert local_copy.read_text() == local_file.read_text()
+    # Copying a file onto itself should fail
+    with pytest.raises(OSError):
+        cp(local_file, local_file)
+    local_file.unlink()
+    local_copy.unlink()
+
+
+def test_dir_io_local(monkeypatch):
+    local_dir = FsPath("test_cp_local_dir")
+    local_copy = FsPath("test_cp_local_dir_copy")
+    for d in [local_dir, local_copy]:
+        if d.exists():
+            d.rmtree()
+    (local_dir / "subdir").mkdir(parents=True)
+    (local_dir / "file.txt").write_text("Some text\n" * 5000)
+    (local_dir / "subdir" / "file.txt").write_text("Some other text\n" * 5000)
+    # Files inside a directory should be copied in the kernel as well
+    def failing_copy2(*args, **kwargs):
+        raise OSError("Not copied in the kernel")
+    monkeypatch.setattr(xaux.fs.io, "copy2", failing_copy2)
+    local_dir.copy_to(local_copy)
+    for f in ["file.txt", "subdir/file.txt"]:
+        assert (local_copy / f).read_text() == (local_dir / f).read_text()
+    local_dir.rmtree()
+    local_copy.rmtree()
+
+
+@pytest.mark.parametrize("method", ["copy_file_range", "sendfile", "splice"])
+def test_file_io_local_kernel(monkeypatch, method):
+    if not hasattr(os, method):
+        pytest.skip(f"`os.{method}` is not available on this system.")
+    # Only allow the given method (and no reflink)
+    monkeypatch.setattr(xaux.fs.io, "fcntl", None)
+    monkeypatch.setattr(xaux.fs.io, "_kernel_copy_chunks",
+                        [getattr(xaux.fs.io, f"_{method}_chunk")])
+    local_file = FsPath("test_cp_local_source.txt")
+    local_copy = FsPath("test_cp_local_target.txt")
+    # Large enough to need several chunks through a pipe
+    local_file.write_text("Some text\n" * 50000)
+    local_copy.write_text("Some other text\n" * 100000)
+    assert xaux.fs.io._copy_in_kernel(local_file, local_copy)
+    assert local_copy.read_text() == local_file.read_text()
+    local_file.unlink()
+    local_copy.unlink()
+
+
 @pytest.mark.skipif(not afs_accessible, reason="AFS is not accessible.")
 @pytest.mark.parametrize("afs_cmd", [0, 1], ids=["xrdcp", "mount"])
 def test_file_io_afs(afs_cmd, test_user):
@@ -6,6 +6,7 @@
 from subprocess import run, TimeoutExpired
 import numpy as np
 from xaux import timestamp, ranID, get_hash, FsPath
+from xaux.tools.general_tools import _blake3_installed
 
 
 def test_timestamp():
@@ -153,5 +154,10 @@ def test_system_lock():
 
 def test_hash():
     hs = get_hash('cronjob_example.py')
-    assert hs == '3eeb344d1236d3d0e2400744c732aded84528a4491600b5533052ced14b03fc5249668' \
-               + '3d2f5e71ac18f4ddf14673a4b53fb06c01c95f1a1d0ea11a485439a17b'
+    if _blake3_installed:
+        assert hs == '678b1afac6445a95cc92a9e841a513b7e4396d7ebd5c2bcbe88b1ed69b2f78b7'
+    else:
+        assert hs == '3eeb344d1236d3d0e2400744c732aded84528a4491600b5533052ced14b03fc5249668' \
+                   + '3d2f5e71ac18f4ddf14673a4b53fb06c01c95f1a1d0ea11a485439a17b'
+    # The legacy chunk size argument is still accepted
+    assert get_hash('cronjob_example.py', size=64) == hs
@@ -3,14 +3,19 @@
 # Copyright (c) CERN, 2025.                 #
 # ######################################### #
 
+import io
 import os
 import json
+import errno
+import fcntl
 import time
 import pytest
 import signal
 from multiprocessing import Pool, Process, Queue
 
-from xaux import FsPath, ProtectFile
+from xaux import FsPath, ProtectFile, ProtectFileError
+import xaux.tools.protectfile as protectfile
+from xaux.tools.protectfile import _inotify_installed, _machine, exit_handler
 
 
 ProtectFile._debug = True
@@ -48,6 +53,29 @@ def change_file_protected(fname, max_lock_time=None, error_queue=None, wait=0.1,
             error_queue.put(e)
     return
 
+def hold_protected(fname, temp_queue, runtime):
+    protect = ProtectFile(fname, "r+", wait=0.1)
+    with protect as pf:
+        temp_queue.put(protect.tempfile.as_posix())
+        rewrite(pf, runtime)
+
+def hold_without_link(fname, error_queue, runtime):
+    # Simulate a file system that does not support hard links (only in this process)
+    def failing(*args, **kwargs):
+        raise OSError(errno.EPERM, "Not supported")
+    os.link = failing
+    change_file_protected(fname, None, error_queue, 0.1, runtime)
+
+def start_crashing_holder(fname):
+    # Start a process that holds the file, and kill it once it has its temporary file
+    temp_queue = Queue()
+    proc = Process(target=hold_protected, args=(fname, temp_queue, 10))
+    proc.start()
+    tempfile = FsPath(temp_queue.get(timeout=10))
+    kill_process(proc)
+    assert tempfile.exists()
+    return tempfile
+
 def change_file_standard(fname):
     with open(fname, "r+") as pf:  # fails with this context
         rewrite(pf)
@@ -177,17 +205,9 @@ def test_normal_crashed():
             with open(fname, "r") as pf:
                 data = json.load(pf)
                 assert data["myint"] == 0
-            assert FsPath(lock_file).exists()
 
-    # After a bit more than a minute, the situation should not have changed
-    time.sleep(90)
-    with open(fname, "r+") as pf:
-        data = json.load(pf)
-        assert data["myint"] == 0
-    assert FsPath(lock_file).exists()
-
-    # So we manually remove the lockfile, and the situation should resolve itself
-    FsPath(lock_file).unlink()
+    # On a local file system, the lock of the crashed process is freed automatically,
+    # even without max_lock_time, so the situation should resolve itself
     for proc in procs:
         proc.join()
 
@@ -197,6 +217,7 @@ def test_normal_crashed():
         data = json.load(pf)
         assert data["myint"] == n_concurrent - 1
     assert not FsPath(lock_file).exists()
+    assert not list(FsPath.cwd().glob(f".{fname}.*.tmp"))
 
     print(f"Total time for {n_concurrent} concurrent jobs: {time.time() - t0:.2f}s")
 
@@ -277,9 +298,356 @@ def test_max_lock_time_crashed():
         data = json.load(pf)
         assert data["myint"] == n_concurrent - 1
     assert not FsPath(lock_file).exists()
+    assert not list(FsPath.cwd().glob(f".{fname}.*.tmp"))
 
     propagate_child_errors(error_queue)
 
     print(f"Total time for {n_concurrent} concurrent jobs: {time.time() - t0:.2f}s")
 
     FsPath(fname).unlink()
+
+
+@pytest.mark.skipif(not _inotify_installed, reason="inotify_simple is not installed")
+def test_wake_up_on_release():
+    fname = "test_wake_up.json"
+    init_file(fname)
+
+    error_queue = Queue()
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+        # args: name, max_lock_time, error_queue, wait, runtime
+        proc = Process(target=change_file_protected, args=(fname, None, error_queue, 20, 0))
+        proc.start()
+        time.sleep(0.5)
+        t0 = time.time()
+    # The waiter should not sleep its full 20s, but be woken up by the lockfile deletion
+    proc.join()
+    assert time.time() - t0 < 5
+    propagate_child_errors(error_queue)
+
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 2
+    assert not FsPath(f"{fname}.lock").exists()
+
+    FsPath(fname).unlink()
+
+
+def test_no_watching_uncontended(monkeypatch):
+    fname = "test_no_watching.json"
+    init_file(fname)
+
+    # The lockfile should only be watched when we actually have to wait
+    def failing(*args, **kwargs):
+        raise AssertionError("Started watching the lockfile without waiting")
+    monkeypatch.setattr(protectfile, "INotify", failing, raising=False)
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    monkeypatch.undo()
+
+    FsPath(fname).unlink()
+
+
+def test_double_release():
+    fname = "test_double_release.json"
+    lock_file = FsPath(f"{fname}.lock")
+    init_file(fname)
+
+    pf1 = ProtectFile(fname, "r+", wait=0.1)
+    with pf1 as pf:
+        rewrite(pf, runtime=0)
+    assert not lock_file.exists()
+    # Another ProtectFile takes the lock, after which the first one is released again
+    # (e.g. by __del__). This should not delete the lockfile of the second one.
+    pf2 = ProtectFile(fname, "r+", wait=0.1)
+    assert lock_file.exists()
+    pf1.release()
+    del pf1
+    assert lock_file.exists()
+    with pf2 as pf:
+        rewrite(pf, runtime=0)
+    assert not lock_file.exists()
+
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 2
+
+    FsPath(fname).unlink()
+
+
+def test_exit_handler():
+    fnames = [f"test_exit_handler_{i}.json" for i in range(3)]
+    for fname in fnames:
+        init_file(fname)
+    pfs = [ProtectFile(fname, "r+", wait=0.1) for fname in fnames]
+
+    def failing_release(*args, **kwargs):
+        raise OSError("Deliberate failure")
+
+    # A failure to release one file should not prevent the others from being released
+    pfs[0].release = failing_release
+    exit_handler()
+    assert FsPath(f"{fnames[0]}.lock").exists()
+    for fname in fnames[1:]:
+        assert not FsPath(f"{fname}.lock").exists()
+
+    del pfs[0].release
+    for pf in pfs:
+        pf.release()
+    for fname in fnames:
+        assert not FsPath(f"{fname}.lock").exists()
+        FsPath(fname).unlink()
+
+
+@pytest.mark.parametrize("max_lock_time", [None, 90])
+def test_lock_is_ours(max_lock_time):
+    fname = "test_lock_is_ours.json"
+    local_lockfile = FsPath(f"{fname}.lock.copy")
+    init_file(fname)
+
+    pf = ProtectFile(fname, "r", wait=0.1, max_lock_time=max_lock_time)
+    assert pf._lock_is_ours()
+    # Verify via the contents (the free_after field is not part of the comparison)
+    data = FsPath(pf.lockfile).read_bytes()
+    local_lockfile.write_bytes(data)
+    assert pf._lock_is_ours(local_lockfile)
+    info = json.loads(data)
+    info["ran"] = f"{int(info['ran']) + 1:0>20d}"
+    local_lockfile.write_bytes(json.dumps(info).encode('utf-8'))
+    assert not pf._lock_is_ours(local_lockfile)
+    pf.release()
+
+    local_lockfile.unlink()
+    FsPath(fname).unlink()
+
+
+@pytest.mark.parametrize("unsupported", ["flock", "link"])
+def test_lock_unsupported(monkeypatch, unsupported):
+    fname = "test_lock_unsupported.json"
+    init_file(fname)
+
+    # Mounts that do not support advisory locks or hard links should still be usable
+    def failing(*args, **kwargs):
+        raise OSError(errno.ENOLCK if unsupported == "flock" else errno.EPERM, "Not supported")
+    if unsupported == "flock":
+        monkeypatch.setattr(protectfile.fcntl, "flock", failing)
+    else:
+        monkeypatch.setattr(protectfile.os, "link", failing)
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    monkeypatch.undo()
+
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 1
+    assert not FsPath(f"{fname}.lock").exists()
+    assert not list(FsPath.cwd().glob(f".{fname}.*"))
+
+    FsPath(fname).unlink()
+
+
+def test_lock_unsupported_concurrent():
+    fname = "test_lock_unsupported_concurrent.json"
+    lock_file = FsPath(f"{fname}.lock")
+    init_file(fname)
+
+    # A lockfile created without hard links has no advisory lock, which does not
+    # mean its owner crashed
+    error_queue = Queue()
+    proc = Process(target=hold_without_link, args=(fname, error_queue, 3))
+    proc.start()
+    t0 = time.time()
+    while not lock_file.exists():
+        assert time.time() - t0 < 10
+        time.sleep(0.01)
+    t0 = time.time()
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        assert time.time() - t0 > 2
+        rewrite(pf, runtime=0)
+    proc.join()
+    propagate_child_errors(error_queue)
+
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 2
+    assert not lock_file.exists()
+
+    FsPath(fname).unlink()
+
+
+@pytest.mark.parametrize("owner", ["other_machine", "no_flock"])
+def test_lock_not_crashed(owner):
+    fname = "test_lock_not_crashed.json"
+    lock_file = FsPath(f"{fname}.lock")
+    init_file(fname)
+
+    # A lockfile of another machine is not locked by our kernel, and neither is a
+    # lockfile that was created without an advisory lock. That does not mean their
+    # owner crashed: they should only be freed after their max_lock_time
+    t0 = time.time()
+    machine = f"{'another.machine': >35s}" if owner == "other_machine" else _machine
+    lock_file.write_text(json.dumps({
+            'ran':        f"{0:0>20d}",
+            'machine':    machine,
+            'free_after': f"{int(t0 + 3):15d}"
+        }))
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        assert time.time() - t0 > 2
+        rewrite(pf, runtime=0)
+    assert not lock_file.exists()
+
+    FsPath(fname).unlink()
+
+
+def test_lock_staging_crashed():
+    fname = "test_lock_staging.json"
+    init_file(fname)
+
+    # Staging files of processes that were killed before publishing their lockfile
+    # are removed, but not those of live processes (which hold their advisory lock)
+    stale = FsPath(f".{fname}.lock.stale.staging")
+    stale.touch()
+    live = FsPath(f".{fname}.lock.live.staging")
+    fd = os.open(live, os.O_WRONLY | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    # The cleanup happens when waiting for the lock
+    start_crashing_holder(fname)
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    assert not stale.exists()
+    assert live.exists()
+    os.close(fd)
+    live.unlink()
+
+    FsPath(fname).unlink()
+
+
+def test_file_changed_during_lock():
+    fname = "test_file_changed.json"
+    init_file(fname)
+
+    with pytest.raises(ProtectFileError, match="changed during lock"):
+        with ProtectFile(fname, "r+", wait=0.1) as pf:
+            rewrite(pf, runtime=0)
+            # Modify the original file behind the back of the ProtectFile
+            with open(fname, "w") as fid:
+                json.dump({"myint": 42}, fid)
+
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 42
+    # The calculation results are saved in a separate file
+    result_files = list(FsPath.cwd().glob(f"{fname}__*.result"))
+    assert len(result_files) == 1
+    with open(result_files[0], "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 1
+    result_files[0].unlink()
+
+    FsPath(fname).unlink()
+
+
+def test_tempfile_rename():
+    fname = "test_tempfile.json"
+    init_file(fname)
+
+    # A file that is ours and has no other hard links is replaced by an atomic rename
+    ino = os.stat(fname).st_ino
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    assert os.stat(fname).st_ino != ino
+
+    # Otherwise the contents are copied, such that the hard link stays intact
+    os.link(fname, f"{fname}.link")
+    ino = os.stat(fname).st_ino
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    assert os.stat(fname).st_ino == ino
+    with open(f"{fname}.link", "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 2
+    assert not list(FsPath.cwd().glob(f".{fname}.*.tmp"))
+
+    FsPath(f"{fname}.link").unlink()
+    FsPath(fname).unlink()
+
+
+def test_tempfile_crashed():
+    fname = "test_tempfile_crashed.json"
+    init_file(fname)
+    tempfile = start_crashing_holder(fname)
+
+    # The temporary file of the crashed process is removed when its lock is freed
+    with ProtectFile(fname, "r+", wait=0.1) as pf:
+        rewrite(pf, runtime=0)
+    assert not tempfile.exists()
+    assert not list(FsPath.cwd().glob(f".{fname}.*.tmp"))
+    assert not FsPath(f"{fname}.lock").exists()
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 1
+
+    FsPath(fname).unlink()
+
+
+def test_tempfile_crashed_sibling():
+    fname = "test_tempfile_sibling.json"
+    sibling = f"{fname}.json"
+    init_file(fname)
+    init_file(sibling)
+    tempfile = start_crashing_holder(fname)
+
+    # Freeing the stale lock should not remove the temporary file of a file
+    # with a similar name
+    protect = ProtectFile(sibling, "r+", wait=0.1)
+    with protect as pf:
+        rewrite(pf, runtime=0)
+        with ProtectFile(fname, "r+", wait=0.1) as pf2:
+            rewrite(pf2, runtime=0)
+        assert not tempfile.exists()
+        assert protect.tempfile.exists()
+    for f in [fname, sibling]:
+        with open(f, "r") as pf:
+            data = json.load(pf)
+            assert data["myint"] == 1
+        assert not FsPath(f"{f}.lock").exists()
+        FsPath(f).unlink()
+
+
+def test_tempfile_deleted():
+    fname = "test_tempfile_deleted.json"
+    init_file(fname)
+
+    protect = ProtectFile(fname, "r+", wait=0.1)
+    with pytest.raises(ProtectFileError, match="disappeared"):
+        with protect as pf:
+            rewrite(pf, runtime=0)
+            protect.tempfile.unlink()
+    protect.release()
+    assert not FsPath(f"{fname}.lock").exists()
+    assert not list(FsPath.cwd().glob(f"{fname}__*.result"))
+    with open(fname, "r") as pf:
+        data = json.load(pf)
+        assert data["myint"] == 0
+
+    FsPath(fname).unlink()
+
+
+def test_raw_io():
+    fname = "test_raw_io.bin"
+    with ProtectFile(fname, "wb", wait=0.1, raw_io=True) as pf:
+        assert isinstance(pf, io.FileIO)
+        pf.write(b"some bytes")
+    with ProtectFile(fname, "r+b", wait=0.1, raw_io=True) as pf:
+        assert isinstance(pf, io.FileIO)
+        data = pf.read()
+        pf.seek(0)
+        pf.truncate()
+        pf.write(data + b" and some more")
+    with open(fname, "rb") as pf:
+        assert pf.read() == b"some bytes and some more"
+    with pytest.raises(ValueError, match="binary mode"):
+        ProtectFile(fname, "r+", wait=0.1, raw_io=True)
+    assert not FsPath(f"{fname}.lock").exists()
+
+    FsPath(fname).unlink()
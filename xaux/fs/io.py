@@ -4,9 +4,14 @@
 # ######################################### #
 
 import os
-from shutil import copy2, copytree
+from functools import partial
+from shutil import copy2, copystat, copytree
 from subprocess import run, PIPE
 import warnings
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from .fs import FsPath
 from .afs import AfsPath, _afs_mounted
@@ -175,9 +180,9 @@ def _cp_regular(sources_targets, follow_symlinks):
     for src, target, recursive in sources_targets:
         if recursive:
             cmd_mess  = f"copytree({src}, {target}, symlinks={not follow_symlinks}, "
-            cmd_mess += "copy_function=copy2)"
+            cmd_mess += "copy_function=_copy2)"
             try:
-                this_stdout = copytree(src.as_posix(), target.as_posix(), symlinks=not follow_symlinks, copy_function=copy2)
+                this_stdout = copytree(src.as_posix(), target.as_posix(), symlinks=not follow_symlinks, copy_function=_copy2)
                 if this_stdout is not None:
                     stdout += this_stdout
                 # Verify the files exist
@@ -191,7 +196,7 @@ def _cp_regular(sources_targets, follow_symlinks):
         else:
             cmd_mess = f"copy2({src}, {target}, follow_symlinks={follow_symlinks})"
             try:
-                this_stdout = copy2(src.as_posix(), target.as_posix(), follow_symlinks=follow_symlinks)
+                this_stdout = _copy2(src.as_posix(), target.as_posix(), follow_symlinks=follow_symlinks)
                 if this_stdout is not None:
                     stdout += this_stdout
                 # Verify the files exist
@@ -205,6 +210,110 @@ def _cp_regular(sources_targets, follow_symlinks):
     return stdout, stderr  # An empty error message means success
 
 
+# Request code of the FICLONE ioctl (see linux/fs.h)
+_FICLONE = 0x40049409
+
+def _copy2(src, target, follow_symlinks=True):
+    # Same as shutil.copy2, but we first try to let the kernel do the copy
+    if (follow_symlinks or not os.path.islink(src)) and _copy_in_kernel(src, target):
+        copystat(src, target, follow_symlinks=follow_symlinks)
+        return target
+    return copy2(src, target, follow_symlinks=follow_symlinks)
+
+
+def _copy_in_kernel(src, target):
+    # Copy a regular file without passing the data through user space.
+    # First try a reflink (a copy-on-write clone, which is O(1) on file systems
+    # that support it, like XFS and Btrfs), then copy_file_range (which can be
+    # offloaded server-side on network file systems), then sendfile, and finally
+    # splice through a pipe. Returns False if none of these is supported, after
+    # which a regular copy has to be done.
+    if os.name == 'nt' or not os.path.isfile(src):
+        return False
+    if os.path.exists(target) and os.path.samefile(src, target):
+        # Let shutil raise the appropriate error
+        return False
+    with open(src, 'rb') as fsrc, open(target, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+                return True
+            except OSError:
+                pass
+        size = os.fstat(src_fd).st_size
+        pipe = None
+        try:
+            for copy_chunk in _kernel_copy_chunks:
+                if copy_chunk is _splice_chunk:
+                    # splice needs a pipe on one end, which is reused for all chunks
+                    pipe = _open_pipe()
+                    copy_chunk = partial(_splice_chunk, pipe=pipe)
+                try:
+                    if _copy_chunks(copy_chunk, src_fd, dst_fd, size):
+                        return True
+                except OSError:
+                    pass
+                # Start over from a clean state for the next method
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+        finally:
+            if pipe is not None:
+                os.close(pipe[0])
+                os.close(pipe[1])
+    return False
+
+
+def _copy_chunks(copy_chunk, src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n_bytes = copy_chunk(src_fd, dst_fd, size - copied)
+        if n_bytes == 0:
+            break
+        copied += n_bytes
+    return copied == size
+
+
+def _copy_file_range_chunk(src_fd, dst_fd, count):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile_chunk(src_fd, dst_fd, count):
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def _splice_chunk(src_fd, dst_fd, count, pipe):
+    pipe_read, pipe_write = pipe
+    n_bytes = os.splice(src_fd, pipe_write, count)
+    written = 0
+    while written < n_bytes:
+        written += os.splice(pipe_read, dst_fd, n_bytes - written)
+    return n_bytes
+
+
+def _open_pipe():
+    pipe_read, pipe_write = os.pipe()
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        # A larger pipe allows larger chunks (the default capacity is 64 KiB)
+        try:
+            fcntl.fcntl(pipe_write, fcntl.F_SETPIPE_SZ, 1 << 20)
+        except OSError:
+            pass
+    return pipe_read, pipe_write
+
+
+# The in-kernel copy methods available on this system, in order of preference
+_kernel_copy_chunks = []
+if hasattr(os, 'copy_file_range'):
+    _kernel_copy_chunks.append(_copy_file_range_chunk)
+if hasattr(os, 'sendfile'):
+    _kernel_copy_chunks.append(_sendfile_chunk)
+if hasattr(os, 'splice'):
+    _kernel_copy_chunks.append(_splice_chunk)
+
+
 def _cp_afs(sources_targets, follow_symlinks):
     from xaux.fs import _skip_afs_software, _force_xrdcp
     this_stdout = ""
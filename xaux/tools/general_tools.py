@@ -5,6 +5,7 @@
 
 import os
 import sys
+import mmap
 import atexit
 import base64
 import hashlib
@@ -13,6 +14,12 @@ import numpy as np
 
 from ..fs import FsPath
 
+try:
+    import blake3
+    _blake3_installed = True
+except ImportError:
+    _blake3_installed = False
+
 
 def timestamp(*, in_filename=False, ms=False, us=False):
     """Timestamp for easy use in logs and filenames.
@@ -85,12 +92,31 @@ def system_lock(lockfile):
         atexit.register(exit_handler)
 
 
-def get_hash(filename, *, size=128):
-    """Get a fast hash of a file, in chunks of 'size' (in kb)"""
-    h  = hashlib.blake2b()
-    b  = bytearray(size*1024)
-    mv = memoryview(b)
+def get_hash(filename, *, size=None):
+    """Get a fast hash of a file.
+    BLAKE3 is used when the `blake3` package is installed (multithreaded
+    for files larger than 1 MiB), otherwise the file is hashed with BLAKE2b.
+    In both cases the file is memory-mapped, to avoid copying its contents
+    into an intermediate buffer.
+    Args:
+        filename (str, Path): Path to the file.
+        size (int): Ignored. Kept for backwards compatibility (the file
+            used to be hashed in chunks of 'size' kb).
+    Returns:
+        str: Hexadecimal digest of the file contents.
+    """
+    if _blake3_installed:
+        if os.path.getsize(filename) > 1 << 20:
+            # Multithreading only pays off for larger files
+            h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        else:
+            h = blake3.blake3()
+        h.update_mmap(filename)
+        return h.hexdigest()
+    h = hashlib.blake2b()
     with open(filename, 'rb', buffering=0) as f:
-        for n in iter(lambda : f.readinto(mv), 0):
-            h.update(mv[:n])
+        # An empty file cannot be memory-mapped
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
     return h.hexdigest()
@@ -8,26 +8,58 @@
 import os
 import io
 import sys
+import stat
+import errno
 import time
 import json
 import atexit
 import signal
-import random
 import traceback
-
-from ..fs import FsPath, EosPath
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    _inotify_installed = True
+except ImportError:
+    _inotify_installed = False
+
+from ..fs import FsPath, LocalPath, EosPath
 from ..fs.temp import _tempdir
 from .general_tools import ranID, get_hash, timestamp
 
 
 protected_open = {}
+_tempdir_path = FsPath(_tempdir.name).resolve()
+
+# The machine name and PID are used in the lockfile. As they do not change during
+# the lifetime of a process, we cache them (the PID is updated in forked children).
+_machine = f"{os.uname().nodename: >35s}"[:35]
+_pid = os.getpid()
+
+def _update_pid():
+    global _pid
+    _pid = os.getpid()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_update_pid)
+
+def _uniform(low, high):
+    # Same as random.uniform, but drawn from os.urandom: forked processes do not
+    # share its state (contrary to the random module), so their wait times do not sync
+    return low + (high - low) * int.from_bytes(os.urandom(4), 'little') / 0xFFFFFFFF
 
 
 # The functions registered via this module are not called when the program is killed by a signal not handled by Python, when a Python fatal internal error is detected, or when os._exit() is called.
 def exit_handler():
     """This handles cleaning of potential leftover lockfiles."""
-    for file in protected_open.values():
-        file.release(pop=False)
+    for file in list(protected_open.values()):
+        # A failure to release one file should not prevent the others from being released
+        try:
+            file.release(pop=False)
+        except Exception as e:
+            print(f"Failed to release {file.file}: {e}")
 
 # This one should handle those exceptions.
 def kill_handler(signum, frame):
@@ -162,7 +194,16 @@ class ProtectFile:
             the lock.
         max_lock_time : float, default None
             If provided, it will write the maximum runtime in seconds inside the
-            lockfile. This is to avoid crashed accesses locking the file forever.
+            lockfile. This is to avoid crashed or hanging accesses locking the file
+            forever. Note that on a local file system, the lock of a crashed process
+            is freed automatically.
+        raw_io : bool, default False
+            Whether or not to use unbuffered file access (only in binary mode).
+            This avoids an intermediate buffer, which is beneficial when the file
+            is read and written in one go (e.g. with pandas). Note that a raw
+            write() might write fewer bytes than requested without raising an
+            error. Its return value has to be checked, and the remainder written
+            again if needed.
 
         Additionally, the following parameters are inherited from open():
             'file', 'mode', 'buffering', 'encoding', 'errors', 'newline', 'closefd', 'opener'
@@ -185,18 +226,21 @@ class ProtectFile:
         # Using a temporary file to write to
         self._use_temporary = arg.pop('use_temporary', True)
         self._check_hash = arg.pop('check_hash', True)
+        raw_io = arg.pop('raw_io', False)
 
         # Initialise paths
         arg['file'] = FsPath(arg['file']).resolve()
         file = arg['file']
         self._file = file
-        self._lock = FsPath(file.parent, file.name + '.lock').resolve()
-        self._temp = FsPath(_tempdir.name, file.name + ranID()).resolve()
+        # The file is resolved, so its siblings do not need to be resolved again
+        self._lock = file.with_name(file.name + '.lock')
+        self._temp = self._get_tempfile(file)
 
         # We throw potential FileNotFoundError and FileExistsError before
         # creating the temporary file
-        self._exists = True if self.file.is_file() else False
-        if not self._exists and self.file.exists():
+        file_stat = self._stat_once()
+        self._exists = file_stat is not None and stat.S_ISREG(file_stat.st_mode)
+        if not self._exists and file_stat is not None:
             raise NotImplementedError("ProtectFile does not yet support "
                                     + "directories or symlinks.")
         mode = arg.get('mode','r')
@@ -211,6 +255,10 @@ class ProtectFile:
                 raise FileExistsError
         if self._readonly:
             self._use_temporary = False
+        if raw_io:
+            if 'b' not in mode:
+                raise ValueError("`raw_io` is only possible in binary mode.")
+            arg['buffering'] = 0
 
         # Provide an expected running time (to free a file in case of crash)
         max_lock_time = arg.pop('max_lock_time', None)
@@ -224,22 +272,29 @@ class ProtectFile:
             print("Warning: `max_lock_time` is too short. Put to 2.")
             max_lock_time = 2
 
+        self._max_lock_time = max_lock_time
+
         # Time to wait between trials to generate lockfile
         wait = arg.pop('wait', 1)
 
         # Try to make lockfile, wait if unsuccesful
         self._access = False
+        self._watcher = None
+        self._watching = False
+        first_wait = True
         while True:
             try:
                 self._create_lock(max_lock_time=max_lock_time)
                 # Success! Or is it....?
-                # We are in the lockfile, but there is still one potential concurrency,
-                # namely another process could have started creating the file while we
-                # did not see it having been created yet...
-                self._flush_lock(wait=1e-3*wait)
-                if not self._lock_is_ours():
-                    self._wait(wait)
-                    continue
+                # On a local file system, O_CREAT|O_EXCL is atomic, so the lockfile is ours.
+                # On a network file system, there is still one potential concurrency, namely
+                # another process could have started creating the file while we did not see
+                # it having been created yet...
+                if self._lock_needs_sync:
+                    self._flush_lock(wait=1e-3*wait)
+                    if not self._lock_is_ours():
+                        self._wait(wait)
+                        continue
                 self._print_debug("init", f"created {self.lockfile}")
                 break
 
@@ -257,7 +312,7 @@ class ProtectFile:
                             self._wait(wait)
                             continue
                         # Make a local lockfile that has the sysinfo
-                        local_lockfile = FsPath(_tempdir.name, file.name + '.lock').resolve()
+                        local_lockfile = _tempdir_path / (file.name + '.lock')
                         if local_lockfile.exists():
                             local_lockfile.unlink()
                         self._create_lock(local_lockfile, max_lock_time, local=True)
@@ -278,46 +333,52 @@ class ProtectFile:
                 # Two typical cases: the lockfile already exists (FileExistsError, a subclass of OSError),
                 # or an input/output error happened while trying to generate it (generic OSError).
                 # In both cases, we wait a bit and try again.
+                if first_wait:
+                    # A good moment to clean up after processes that were killed while
+                    # creating their lockfile (as there is nothing else to do anyway)
+                    first_wait = False
+                    self._remove_stale_staging()
                 self._wait(wait)
                 # We also have to capture the case where the lockfile expired and can be freed.
                 # So we try to read it and look for the timeout period; if this fails (e.g. because the
                 # lock disappeared in the meanwhile), we continue the mainloop
                 try:
-                    kill_lock = False
-                    with self.lockfile.open('r') as fid:
-                        info = json.load(fid)
-                    if 'free_after' in info and int(info['free_after']) > 0 \
-                    and int(info['free_after']) < time.time():
-                        # We free the original process by deleting the lockfile
+                    if self._free_stale_lock():
+                        # We freed the original process by deleting the lockfile
                         # and then we go to the next step in the while loop.
                         # Note that this does not necessarily imply this process
                         # gets to use the file; which is the intended behaviour
                         # (first one wins).
-                        kill_lock = True
-                    if kill_lock:
-                        self.lockfile.unlink()
                         self._print_debug("init",f"freed {self.lockfile} because "
-                                            + "of exceeding max_lock_time")
+                                            + "of exceeding max_lock_time or a crash")
                     # Whether or not the lockfile was freed, we continue to the main loop
                     continue
 
-                except (OSError, json.JSONDecodeError):
+                except (OSError, ValueError):
                     # Any error in trying to read (and potentially kill the lock) implies
                     # a return to the main loop
                     continue
 
         # Success!
+        self._stop_watching()
         self._access = True
         self._delete_lock_at_finish = True
 
+        # Force an update from the file system (a bit slow ~100ms, but necessary)
+        if self._lock_needs_sync:
+            self._file.flush()
+
         # Store stats (to check if file got corrupted later)
+        # This is done after the flush, as the latter touches the file.
+        # The stats are taken before the hash, such that any change after them is detected.
+        self._stat = None
         if self._check_hash and self._exists:
-            self._size = self.file.size()
+            file_stat = self.file.stat()
+            self._size = file_stat.st_size
+            if not isinstance(self.file, EosPath):
+                self._stat = file_stat
             self._hash = get_hash(self.file)
 
-        # Force an update from the file system (a bit slow ~100ms, but necessary)
-        self._file.flush()
-
         # Choose file pointer:
         # To the temporary file if writing, or existing file if read-only
         if self._use_temporary:
@@ -334,15 +395,65 @@ class ProtectFile:
     def _wait(self, wait):
         # Add some white noise to the wait time to avoid different processes syncing
         if self._testing:
-            this_wait = random.uniform(wait*0.999, wait*1.001)
+            this_wait = _uniform(wait*0.999, wait*1.001)
         else:
-            this_wait = random.uniform(wait*0.6, wait*1.4)
+            this_wait = _uniform(wait*0.6, wait*1.4)
         self._print_debug("init", f"waiting {this_wait}s to create {self.lockfile}")
-        time.sleep(this_wait)
+        if not getattr(self, '_watching', True):
+            # Only start watching once we have to wait, as it costs a few system calls
+            self._start_watching()
+            if self._watcher is not None and not self.lockfile.exists():
+                # The lockfile got deleted before we started watching
+                return
+        if getattr(self, '_watcher', None) is None:
+            time.sleep(this_wait)
+            return
+        # Wake up as soon as the lockfile is deleted
+        deadline = time.time() + this_wait
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = self._watcher.read(timeout=max(1, int(1e3*remaining)))
+            if any(event.name == self.lockfile.name for event in events):
+                self._print_debug("init", f"woken up by deletion of {self.lockfile}")
+                return
+
+
+    def _start_watching(self):
+        # Watch the parent directory for the deletion of the lockfile (Linux only).
+        # This is not reliable on network file systems, where we just poll.
+        self._watcher = None
+        self._watching = True
+        if not _inotify_installed or self._lock_needs_sync:
+            return
+        try:
+            self._watcher = INotify()
+            self._watcher.add_watch(self.lockfile.parent,
+                                    inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+        except OSError:
+            self._stop_watching()
+
+
+    def _stop_watching(self):
+        if getattr(self, '_watcher', None) is not None:
+            self._watcher.close()
+        self._watcher = None
+
+
+    @property
+    def _lock_needs_sync(self):
+        # Only on a local file system we can trust the atomicity of the lockfile creation
+        return not isinstance(self.lockfile, LocalPath)
 
 
     def _create_lock(self, lockfile=None, max_lock_time=None):
-        self.lockfile.getfid() # Look up the file on the server (takes a few ms)
+        if self._lock_needs_sync:
+            self.lockfile.getfid() # Look up the file on the server (takes a few ms)
+        # On a local file system, we keep an advisory lock on the lockfile for as long
+        # as we hold it. The kernel releases it when the process dies, which allows
+        # other processes to detect a crash.
+        keep_flock = lockfile is None and fcntl is not None and not self._lock_needs_sync
         if lockfile is None:
             lockfile = self.lockfile
         free_after = -1
@@ -350,18 +461,77 @@ class ProtectFile:
             free_after = int(time.time() + max_lock_time)
         free_after = f"{free_after:15d}"[:15]
         # We ensure that the variables in the lockfile always have a fixed number of characters
-        ran = random.randint(0, 2**63 - 1) + os.getpid() + int(time.time_ns() % 1e9)
+        ran = (int.from_bytes(os.urandom(8), 'little') >> 1) + _pid + int(time.time_ns() % 1e9)
         self._ran = f"{ran:0>20d}"
-        self._machine = f"{os.uname().nodename: >35s}"[:35]
-        with lockfile.open('x') as flock:
-            json.dump({
+        self._machine = _machine
+        info = {
                 'ran':     self._ran,
                 'machine': self._machine,
                 'free_after': free_after
-            }, flock)
+            }
+        if self._use_temporary and self.tempfile.parent == self.file.parent:
+            # Such that our temporary file can be cleaned up if we crash
+            info['tempfile'] = self.tempfile.name
+        # The part of the lockfile that identifies us (everything except the closing
+        # brace and free_after), which allows to verify the lock with a bytes comparison
+        self._lock_prefix = json.dumps({
+                'ran':     self._ran,
+                'machine': self._machine
+            }).encode('utf-8')[:-1]
+        if not keep_flock or not self._publish_lock(info):
+            # Write the lockfile in one go, bypassing the buffered io layer
+            payload = json.dumps(info).encode('utf-8')
+            flock = os.open(lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                os.write(flock, payload)
+                os.fsync(flock)
+            finally:
+                os.close(flock)
         self._print_debug("init", f"Trying lockfile with metadata {free_after=} ran={self._ran} machine={self._machine}")
 
 
+    def _publish_lock(self, info):
+        # The lockfile is prepared (locked and written) under a temporary name, and
+        # only then hard linked to its final name (which is atomic, and fails if the
+        # lockfile exists). Hence a lockfile can never be seen empty or unlocked while
+        # its owner is alive, not even when the owner is killed halfway.
+        # Returns False if hard links are not supported on this file system.
+        staging = self.lockfile.with_name(f".{self.lockfile.name}.{ranID()}.staging")
+        flock = os.open(staging, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                fcntl.flock(flock, fcntl.LOCK_EX)
+                has_flock = True
+            except OSError:
+                # Not supported on this mount (e.g. NFS with nolock or some FUSE
+                # file systems); then only max_lock_time can free a crashed lock
+                has_flock = False
+            if has_flock:
+                # Only a lockfile with this marker can be freed by taking its flock
+                info = {**info, 'flock': True}
+            os.write(flock, json.dumps(info).encode('utf-8'))
+            os.fsync(flock)
+            os.link(staging, self.lockfile)
+        except OSError as e:
+            os.close(flock)
+            if e.errno in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS):
+                return False
+            raise
+        except:
+            os.close(flock)
+            raise
+        finally:
+            try:
+                os.unlink(staging)
+            except FileNotFoundError:
+                pass
+        if has_flock:
+            self._lock_fd = flock
+        else:
+            os.close(flock)
+        return True
+
+
     def _flush_lock(self, local_lockfile=None, wait=0.01):
         if local_lockfile:
             # Move it to the server lockfile
@@ -370,9 +540,9 @@ class ProtectFile:
         # Flush the file on the server (a bit slow ~100ms, but necessary)
         self.lockfile.flush()
         if self._testing:
-            this_wait = random.uniform(0.099, 0.101)
+            this_wait = _uniform(0.099, 0.101)
         else:
-            this_wait = 0.001 + random.uniform(wait*0.6, wait*1.4)
+            this_wait = 0.001 + _uniform(wait*0.6, wait*1.4)
         self._print_debug("init", f"flushing lock and waiting {this_wait}s to ensure sync")
         time.sleep(this_wait)
         if local_lockfile:
@@ -381,6 +551,78 @@ class ProtectFile:
             assert local_lockfile.is_file()    # sanity check
 
 
+    def _free_stale_lock(self):
+        # Delete the lockfile if its max_lock_time has expired, or if its owner has
+        # crashed. The latter is the case when we can take the advisory lock on it (as
+        # the owner takes it before publishing the lockfile). We only trust this when
+        # the lockfile is marked as such (which is not the case when it was created
+        # without an advisory lock, or by an older version), and when the owner is on
+        # the same machine: on network file systems, the advisory lock might only be
+        # enforced within the kernel of a single client.
+        with self.lockfile.open('rb') as fid:
+            info = json.loads(fid.read())
+            free_after = int(info.get('free_after', -1))
+            expired = free_after > 0 and free_after < time.time()
+            local = fcntl is not None and not self._lock_needs_sync \
+                    and info.get('machine') == _machine and info.get('flock') is True
+            crashed = False
+            if local and not expired:
+                try:
+                    fcntl.flock(fid.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    crashed = True
+                except OSError:
+                    # Either the owner is alive, or advisory locks are not supported
+                    pass
+            if not crashed and not expired:
+                return False
+            # Verify that the lockfile was not replaced in the meanwhile
+            if local and os.fstat(fid.fileno()).st_ino != self.lockfile.stat().st_ino:
+                return False
+            # The temporary file of the previous owner will never be moved back.
+            # This has to be done before deleting the lockfile, as afterwards a
+            # new owner could already have created its own temporary file.
+            self._remove_stale_tempfile(info)
+            self.lockfile.unlink()
+        return True
+
+
+    def _remove_stale_staging(self):
+        # Remove the lockfile staging files of processes that were killed before
+        # publishing them (a live process keeps the advisory lock on its staging file)
+        if fcntl is None or self._lock_needs_sync:
+            return
+        for staging in self.lockfile.parent.glob(f".{self.lockfile.name}.*.staging"):
+            try:
+                fd = os.open(staging, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Verify that the staging file was not replaced in the meanwhile
+                if os.fstat(fd).st_ino == os.stat(staging).st_ino:
+                    self._print_debug("init", f"unlink stale {staging}")
+                    os.unlink(staging)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
+    def _remove_stale_tempfile(self, info):
+        # Only the temporary file registered in the lockfile is removed (as other
+        # hidden files next to ours might be in use by other ProtectFiles)
+        name = info.get('tempfile')
+        if not isinstance(self.file, LocalPath) or not isinstance(name, str) \
+        or os.path.basename(name) != name or not name.startswith(f".{self.file.name}."):
+            return
+        temp = self.file.parent / name
+        self._print_debug("init", f"unlink stale {temp}")
+        try:
+            temp.unlink()
+        except FileNotFoundError:
+            pass
+
+
     def _lock_is_empty(self, i=1):
         if i > 15:
             return True
@@ -394,6 +636,13 @@ class ProtectFile:
     def _lock_is_ours(self, lockfile=None):
         if lockfile is None:
             lockfile = self.lockfile
+        if lockfile == self.lockfile and getattr(self, '_lock_fd', None) is not None:
+            # We hold the advisory lock on our lockfile, so we only need to verify it
+            # was not replaced (its inode cannot be reused as long as we keep it open)
+            try:
+                return os.fstat(self._lock_fd).st_ino == lockfile.stat().st_ino
+            except OSError:
+                return False
         if not lockfile.exists():
             return False
         if self._lock_is_empty():
@@ -401,19 +650,15 @@ class ProtectFile:
             lockfile.unlink()
             return False
         try:
-            with lockfile.open('r') as fid:
-                info = json.load(fid)
-        except:
-            # If we cannot load the json, it might be empty or being written to
-            self._print_debug("lock_is_ours", f"cannot load json info from {lockfile}")
+            with lockfile.open('rb') as fid:
+                data = fid.read()
+        except OSError:
+            self._print_debug("lock_is_ours", f"cannot read {lockfile}")
             return False
-        if 'ran' not in info or info['ran'] != self._ran:
-            ran = info['ran'] if 'ran' in info else 'None'
-            self._print_debug("lock_is_ours", f"ran info changed in {lockfile} ({ran} vs {self._ran})")
-            return False
-        if 'machine' not in info or info['machine'] != self._machine:
-            machine = info['machine'] if 'machine' in info else 'None'
-            self._print_debug("lock_is_ours", f"machine info changed in {lockfile} ({machine} vs {self._machine})")
+        if not data.startswith(self._lock_prefix):
+            self._print_debug("lock_is_ours", f"info changed in {lockfile} "
+                                            + f"({data.decode(errors='replace')} vs ran={self._ran} "
+                                            + f"machine={self._machine})")
             return False
         # We got here, so the lockfile is ours
         return True
@@ -429,49 +674,81 @@ class ProtectFile:
         if not self._access:
             return
         # Close file pointer
-        if not self._fd.closed:
+        if self._fd is not None and not self._fd.closed:
             self._fd.close()
         # Check that the lock is still ours
         if not self._lock_is_ours(self.lockfile):
             self._delete_lock_at_finish = False
             self.stop_with_error(f"Lockfile {self.lockfile} is not ours anymore.")
             return
-        # Check that we did not run out of time
-        try:
-            with self.lockfile.open('r') as fid:
-                info = json.load(fid)
-        except:
-            self._delete_lock_at_finish = False
-            self.stop_with_error("Loading JSON from lockfile failed.")
-            return
-        if 'free_after' in info and int(info['free_after']) > 0 and int(info['free_after']) < time.time():
-            # Max runtime was expired. We have to forfeit the job as this is a potential failure point.
-            self.stop_with_error(f"Error: Job {self._file} took longer than expected ("
-                + f"{round(time.time() - int(info['free_after']))}s. Increase max_lock_time.")
-            return
+        # Check that we did not run out of time (only possible if max_lock_time is set)
+        if self._max_lock_time is not None:
+            try:
+                with self.lockfile.open('r') as fid:
+                    info = json.load(fid)
+            except:
+                self._delete_lock_at_finish = False
+                self.stop_with_error("Loading JSON from lockfile failed.")
+                return
+            if 'free_after' in info and int(info['free_after']) > 0 and int(info['free_after']) < time.time():
+                # Max runtime was expired. We have to forfeit the job as this is a potential failure point.
+                self.stop_with_error(f"Error: Job {self._file} took longer than expected ("
+                    + f"{round(time.time() - int(info['free_after']))}s. Increase max_lock_time.")
+                return
         # Check that original file was not modified in between (i.e. corrupted)
         file_changed = False
         if self._use_temporary and self._check_hash and self._exists:
-            new_size = self.file.size()
-            new_hash = get_hash(self.file)
-            if self._hash != new_hash:
-                file_changed = True
-            # for key, val in self._fstat.items():
-            #     if key not in new_stats or val != new_stats[key]:
-            #         file_changed = True
+            new_stat = self.file.stat()
+            if not self._stat_unchanged(new_stat):
+                new_size = new_stat.st_size
+                new_hash = get_hash(self.file)
+                if self._hash != new_hash:
+                    file_changed = True
         if file_changed:
             self.stop_with_error(f"Error: File {self.file} changed during lock! "
                 + f"Original size: {self._size}, new size: {new_size}. "
                 + f"Original hash: {self._hash}, new hash: {new_hash}.")
         else:
             # All is fine: move result from temporary file to original
-            self.mv_temp()
-            # Flag the changes to the server
-            self.file.getfid()
-            time.sleep(random.uniform(0.1, 0.2))
+            try:
+                self.mv_temp()
+            except FileNotFoundError:
+                # The temporary file got removed, e.g. because our lock was freed
+                self._delete_lock_at_finish = self._lock_is_ours(self.lockfile)
+                self.stop_with_error(f"Temporary file {self.tempfile} disappeared during lock.")
+                return
+            if self._lock_needs_sync:
+                # Flag the changes to the server
+                self.file.getfid()
+                time.sleep(_uniform(0.1, 0.2))
             self.release()
 
 
+    def _stat_once(self):
+        # A single stat call (or RPC on EOS) to get all info about the file
+        try:
+            return self.file.stat()
+        except FileNotFoundError:
+            return None
+
+
+    def _stat_unchanged(self, new_stat):
+        # Cheap check before re-hashing: if the inode, size, and modification
+        # time did not change, the file was not touched during the lock.
+        if self._stat is None:
+            return False
+        return (new_stat.st_ino, new_stat.st_size, new_stat.st_mtime_ns) \
+            == (self._stat.st_ino, self._stat.st_size, self._stat.st_mtime_ns)
+
+
+    def _get_tempfile(self, file):
+        # Prefer a hidden file next to the original, so that it can be moved back
+        # with an atomic rename. Otherwise use the global temporary directory.
+        if isinstance(file, LocalPath) and os.access(file.parent, os.W_OK):
+            return FsPath(file.parent, f".{file.name}.{ranID()}.tmp")
+        return _tempdir_path / (file.name + ranID())
+
+
     @property
     def file(self):
         return self._file
@@ -492,31 +769,53 @@ class ProtectFile:
         if self._use_temporary:
             if destination is None:
                 # Move temporary file to original file
-                self._print_debug("mv_temp", f"cp {self.tempfile=} to {self.file=}")
-                self.tempfile.copy_to(self.file)
-                # # Check if copy succeeded
-                # if self._check_hash and get_hash(self.tempfile) != get_hash(self.file):
-                #     self.stop_with_error(f"Warning: tried to copy temporary file {self.tempfile} into {self.file}, "
-                #           + "but hashes do not match!")
-            else:
-                self._print_debug("mv_temp", f"cp {self.tempfile=} to {destination=}")
-                self.tempfile.copy_to(destination)
+                destination = self.file
+            if not self.tempfile.is_file():
+                raise FileNotFoundError(f"Temporary file {self.tempfile} does not exist.")
+            if isinstance(self.tempfile, LocalPath) and isinstance(destination, LocalPath) \
+            and self._can_replace(destination):
+                # A rename is atomic: readers see either the old or the new file
+                self._print_debug("mv_temp", f"mv {self.tempfile=} to {destination=}")
+                try:
+                    os.replace(self.tempfile, destination)
+                    return
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            self._print_debug("mv_temp", f"cp {self.tempfile=} to {destination=}")
+            self.tempfile.copy_to(destination)
             self._print_debug("mv_temp", f"unlink {self.tempfile=}")
             self.tempfile.unlink()
 
 
+    def _can_replace(self, destination):
+        # A rename replaces the inode of the destination, which would change its owner
+        # (and group) to ours, and break its hard links. In those cases we copy instead.
+        try:
+            dest_stat = os.stat(destination)
+        except FileNotFoundError:
+            return True
+        temp_stat = os.stat(self.tempfile)
+        return dest_stat.st_nlink == 1 and (dest_stat.st_uid, dest_stat.st_gid) \
+                                        == (temp_stat.st_uid, temp_stat.st_gid)
+
+
     def stop_with_error(self, message):
         """Fail the job, and potentially save calculation results"""
         if not self._access:
             return
-        self._access = False
         results_saved = False
         alt_file = None
         if self._use_temporary:
             extension = f"__{timestamp(us=True, in_filename=True)}.result"
-            alt_file = FsPath(self.file.parent, self.file.name + extension).resolve()
-            self.mv_temp(alt_file)
-            results_saved = True
+            alt_file = self.file.with_name(self.file.name + extension)
+            # This has to happen before revoking access, as mv_temp needs it
+            try:
+                self.mv_temp(alt_file)
+                results_saved = True
+            except FileNotFoundError:
+                alt_file = None
+        self._access = False
         raise ProtectFileError(message, results_saved, alt_file)
 
 
@@ -527,6 +826,10 @@ class ProtectFile:
         # Close main file pointer
         if hasattr(self,'_fd') and hasattr(self._fd,'closed') and not self._fd.closed:
             self._fd.close()
+        # Drop the file object, such that its buffer can be freed immediately
+        self._fd = None
+        # Stop watching the lockfile
+        self._stop_watching()
         # Delete temporary file
         if hasattr(self,'_temp') and hasattr(self._temp,'is_file') and self._temp.is_file():
             self._print_debug("release", f"unlink {self.tempfile}")
@@ -536,6 +839,12 @@ class ProtectFile:
             if hasattr(self,'_lock') and hasattr(self._lock,'is_file') and self._lock.is_file():
                 self._print_debug("release", f"unlink {self.lockfile}")
                 self.lockfile.unlink()
+            # Only delete the lockfile once, as it might be another process's lockfile by now
+            self._delete_lock_at_finish = False
+        # Release the advisory lock (only after deleting the lockfile)
+        if getattr(self, '_lock_fd', None) is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
         # Remove file from the protected register
         if pop and hasattr(self, '_file'):
             protected_open.pop(self._file, 0)